@@ -0,0 +1,78 @@
+import numpy as np
+
+RESOLUTIONS = [15, 30, 60, 120, 240, 1440]  # Bin sizes in minutes; each divides a day
+
+
+def _occupied_minutes(times, lots, n_lots, edges, base, stride):
+    """Sweep-line integral per lot: sum of max(0, edge - t) over the lot's events"""
+    # One flat sort orders the events by lot, then time
+    keys = np.sort(lots * stride + (times - base))
+    rel = keys - np.floor(keys / stride) * stride
+    cumulative = np.concatenate(([0.0], np.cumsum(rel)))
+
+    x = (edges - base)[None, :]
+    lot_offsets = np.arange(n_lots)[:, None] * stride
+    upto = np.searchsorted(keys, lot_offsets + x)
+    first = np.searchsorted(keys, lot_offsets)
+    return (upto - first) * x - (cumulative[upto] - cumulative[first])
+
+
+def occupancy_series(starts, ends, lots, n_lots, edges):
+    """Average number of parked vehicles per lot in each bin.
+
+    starts/ends are minutes on any common scale, lots the lot index
+    (0..n_lots-1) of each stay and edges the ascending bin edges. Instead of
+    looping over stays, start and end events are sorted once per lot and the
+    occupancy integral at every edge is read off their running sums.
+    Returns an (n_lots, len(edges) - 1) array.
+    """
+    starts = np.asarray(starts, dtype=float)
+    ends = np.maximum(np.asarray(ends, dtype=float), starts)
+    lots = np.asarray(lots, dtype=np.int64)
+    edges = np.asarray(edges, dtype=float)
+    if len(starts) == 0:
+        return np.zeros((n_lots, len(edges) - 1))
+
+    # Per-lot key ranges must not overlap, so stride past the largest time
+    base = min(edges[0], starts.min())
+    stride = np.ceil(max(edges[-1], ends.max()) - base) + 1
+    occupied = (_occupied_minutes(starts, lots, n_lots, edges, base, stride) -
+                _occupied_minutes(ends, lots, n_lots, edges, base, stride))
+    return np.diff(occupied, axis=1) / np.diff(edges)
+
+
+def weekly_heatmap(occupancy, capacity, weekdays, hours):
+    """Average utilisation (0-1) by weekday and hour across all given lots.
+
+    occupancy is (n_lots, n_bins), capacity the spot count per lot and
+    weekdays/hours the weekday (Mon=0) and hour of each bin's start.
+    """
+    total_capacity = capacity.sum()
+    heatmap = np.zeros((7, 24))
+    if total_capacity == 0 or occupancy.shape[1] == 0:
+        return heatmap
+    utilisation = occupancy.sum(axis=0) / total_capacity
+    cell = weekdays * 24 + hours
+    counts = np.bincount(cell, minlength=7 * 24)
+    sums = np.bincount(cell, weights=utilisation, minlength=7 * 24)
+    filled = counts > 0
+    heatmap.flat[filled] = sums[filled] / counts[filled]
+    return heatmap
+
+
+def utilisation_stats(occupancy, capacity, hours, percentiles=(50, 90, 99)):
+    """Per-lot utilisation percentiles, mean, max and busiest hour of day"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        utilisation = np.where(capacity[:, None] > 0, occupancy / capacity[:, None], 0.0)
+    if utilisation.shape[1] == 0:
+        utilisation = np.zeros((len(capacity), 1))
+        hours = np.zeros(1, dtype=np.int64)
+    hourly = np.stack([np.bincount(hours, weights=row, minlength=24) for row in utilisation])
+    counts = np.bincount(hours, minlength=24)
+    hourly = np.divide(hourly, counts, out=np.zeros_like(hourly), where=counts > 0)
+    return {
+        'percentiles': np.percentile(utilisation, percentiles, axis=1).T,
+        'mean': utilisation.mean(axis=1),
+        'max': utilisation.max(axis=1),
+        'peak_hour': hourly.argmax(axis=1)
+    }
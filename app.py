@@ -1,23 +1,55 @@
-from flask import Flask, request, render_template, session, url_for, redirect, flash
-from models import db, User, Admin, Lot, Spot, Reservation
+from flask import Flask, request, render_template, session, url_for, redirect, flash, jsonify
+from markupsafe import Markup
+from models import db, User, Admin, Lot, LotTariff, Spot, Reservation, AdvanceBooking, LOT_VERSION_TRIGGERS, BOOKING_VERSION_TRIGGERS
+from spot_schedule import SpotSchedule
+from billing import FLAT_TARIFF, WEEKDAYS, build_tariff, compute_charge, compute_charges, parse_daily_cap, to_minutes
+from scheduler import LeaderScheduler
+from fragment_cache import create_cache, LRUCache
+from analytics import RESOLUTIONS, occupancy_series, weekly_heatmap, utilisation_stats
+from sharding import SHARDED_TABLES, PRIMARY_SHARD, UnknownShardError, shards
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime
+from sqlalchemy.schema import CreateIndex
+from contextlib import contextmanager
+from datetime import datetime, date, timedelta
 from flask_mail import Mail, Message
 import os
-from threading import Thread
+import click
+import numpy as np
+from queue import Queue
+from threading import Thread, Lock
 
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+# Outgoing mail is queued and sent by a single background worker
+mail_queue = Queue()
+mail_worker_lock = Lock()
+mail_worker = None
+
+def send_queued_emails(app):
+    while True:
+        msg = mail_queue.get()
+        try:
+            with app.app_context():
+                mail.send(msg)
+        except Exception as e:
+            print(f"Error sending queued email: {e}")
+        finally:
+            mail_queue.task_done()
 
 def send_email(msg):
-    Thread(target=send_async_email, args=(app, msg)).start()
+    global mail_worker
+    with mail_worker_lock:
+        if mail_worker is None:
+            mail_worker = Thread(target=send_queued_emails, args=(app,), daemon=True)
+            mail_worker.start()
+    mail_queue.put(msg)
 
 app = Flask(__name__, instance_relative_config=True)
 
 app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///project.db"
 app.config['SECRET_KEY'] = 'a-very-secret-and-unique-key'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['FRAGMENT_CACHE'] = os.getenv('FRAGMENT_CACHE', 'memory')  # 'memory' or 'sqlite' (shared by workers)
+# Regional shards by pincode prefix, e.g. '1:11,12=sqlite:///north.db;2:60=sqlite:///south.db'
+app.config['SQLALCHEMY_BINDS'] = shards.configure(os.getenv('PARKING_SHARDS', ''))
 
 # Email configuration
 app.config["MAIL_SERVER"] = os.getenv("MAIL_SERVER")
@@ -36,9 +68,52 @@ mail = Mail(app)
 
 db.init_app(app)
 
+def upgrade_schema(conn):
+    """Add what create_all() skips on tables that already exist"""
+    existing = set(db.inspect(conn).get_table_names())
+    # Indexes...
+    for table in db.metadata.sorted_tables:
+        if table.name in existing:
+            for index in table.indexes:
+                conn.execute(CreateIndex(index, if_not_exists=True))
+    # ...columns added to existing tables
+    new_columns = {
+        'reservation': [('total_cost', 'FLOAT'), ('overstay_flagged_at', 'DATETIME')],
+        'lot': [('version', 'INTEGER NOT NULL DEFAULT 1'), ('cache_token', "VARCHAR(32) NOT NULL DEFAULT ''")],
+        'spot': [('booking_version', 'INTEGER NOT NULL DEFAULT 0')]
+    }
+    for table, table_columns in new_columns.items():
+        columns = {column['name'] for column in db.inspect(conn).get_columns(table)}
+        for name, column_type in table_columns:
+            if name not in columns:
+                conn.execute(db.text(f'ALTER TABLE {table} ADD COLUMN {name} {column_type}'))
+    conn.execute(db.text("UPDATE lot SET cache_token = lower(hex(randomblob(16))) WHERE cache_token = ''"))
+    for trigger in LOT_VERSION_TRIGGERS + BOOKING_VERSION_TRIGGERS:
+        conn.execute(db.text(trigger))
+
+def create_shard_schema(shard):
+    """Create the sharded tables in a regional shard, with ids starting in its range"""
+    engine = db.engines[shards.bind_key(shard)]
+    db.metadata.create_all(engine, tables=[t for t in db.metadata.sorted_tables if t.name in SHARDED_TABLES])
+    with engine.begin() as conn:
+        upgrade_schema(conn)
+        first_id = shards.id_range(shard)[0]
+        for table in ('lot', 'reservation', 'advance_booking'):
+            conn.execute(db.text(
+                'INSERT INTO sqlite_sequence (name, seq) SELECT :name, :seq '
+                'WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = :name)'
+            ), {'name': table, 'seq': first_id})
+
 # Create all tables in the database
 with app.app_context():
     db.create_all()
+    with db.engine.begin() as conn:
+        upgrade_schema(conn)
+    for shard in shards.ids:
+        if shard != PRIMARY_SHARD:
+            create_shard_schema(shard)
+    os.makedirs(app.instance_path, exist_ok=True)
+    fragment_cache = create_cache(app.config['FRAGMENT_CACHE'], os.path.join(app.instance_path, 'fragments.db'))
     try:
         admin = Admin(username='admin', password=generate_password_hash('adminpass'))
         db.session.add(admin)
@@ -207,6 +282,41 @@ def send_release_notification_email(user, reservation, spot, lot, total_cost, du
         print(f"Error sending release notification email: {e}")
         return False 
 
+def send_overstay_warning_email(user, reservation, spot, lot, release_at):
+    """Warn the user that their parking session has run unusually long"""
+    try:
+        msg = Message(
+            subject='Parking Spot Still Occupied - Overstay Warning',
+            recipients=[user.email]
+        )
+        
+        msg.html = f"""
+        <html>
+        <body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333;">
+            <div style="max-width: 600px; margin: 0 auto; padding: 20px; border: 1px solid #ddd; border-radius: 10px;">
+                <h2 style="color: #dc3545; border-bottom: 2px solid #dc3545; padding-bottom: 10px;">Overstay Warning</h2>
+                
+                <p>Dear <strong>{user.name}</strong>,</p>
+                
+                <p>Your vehicle <strong>{reservation.vehicle_number}</strong> has been parked at spot {spot.id}, {lot.prime_location_name} since {reservation.parking_timestamp.strftime('%d %b %Y, %I:%M %p')}.</p>
+                
+                <p style="color: #856404; background-color: #fff3cd; padding: 10px; border-radius: 5px;">
+                    <strong>Note:</strong> If the spot is not released, it will be released automatically on {release_at.strftime('%d %b %Y, %I:%M %p')} and billed up to that time.
+                </p>
+                
+                <hr style="border: none; border-top: 1px solid #ddd; margin: 20px 0;">
+                <p style="font-size: 12px; color: #6c757d;">This is an automated message. Please do not reply to this email.</p>
+            </div>
+        </body>
+        </html>
+        """
+        
+        send_email(msg)
+        return True
+    except Exception as e:
+        print(f"Error sending overstay warning email: {e}")
+        return False
+
 # Helper functions for session management
 def is_logged_in():
     """Check if any user is logged in"""
@@ -237,6 +347,446 @@ def get_current_user():
     else:
         return db.session.get(User, session['user_id'])
 
+# Advance reservations
+RESERVATION_HOLD_MINUTES = 15  # Spot turns 'R' this long before a booked window starts
+WALK_IN_BUFFER_HOURS = 2  # Walk-ins and near-term bookings must stay clear of booked windows this far ahead
+MAX_BOOKING_HOURS = 24
+MAX_ADVANCE_DAYS = 30
+LIVE_BOOKING_STATUSES = ('B', 'I')
+
+spot_schedule = SpotSchedule()
+
+def get_spot_schedule():
+    """Interval index of upcoming bookings, loaded from the database on first use"""
+    if not spot_schedule.loaded:
+        # Versions first: a booking made in between only makes the index look stale
+        versions = shards.gather(db.session.query(Spot.id, Spot.booking_version))
+        rows = shards.gather(db.session.query(
+            AdvanceBooking.spot_id, AdvanceBooking.start_time, AdvanceBooking.end_time, AdvanceBooking.id
+        ).filter(
+            AdvanceBooking.status.in_(LIVE_BOOKING_STATUSES),
+            AdvanceBooking.end_time > datetime.now()
+        ))
+        spot_schedule.load(rows, versions)
+    return spot_schedule
+
+def get_booking_versions(spot_ids):
+    """Current booking_version of each spot, as {spot_id: version}"""
+    return dict(db.session.query(Spot.id, Spot.booking_version).filter(Spot.id.in_(spot_ids)).all())
+
+def refresh_spot_schedule(versions):
+    """Reload the windows of spots at the given {spot_id: version}, e.g. after another worker booked them"""
+    # Spot ids are unique across shards, so one index serves them all
+    rows = db.session.query(
+        AdvanceBooking.spot_id, AdvanceBooking.start_time, AdvanceBooking.end_time, AdvanceBooking.id
+    ).filter(
+        AdvanceBooking.spot_id.in_(versions),
+        AdvanceBooking.status.in_(LIVE_BOOKING_STATUSES),
+        AdvanceBooking.end_time > datetime.now()
+    ).all()
+    bookings = {spot_id: [] for spot_id in versions}
+    for spot_id, start, end, booking_id in rows:
+        bookings[spot_id].append((start, end, booking_id))
+    for spot_id, spot_bookings in bookings.items():
+        spot_schedule.replace_spot(spot_id, spot_bookings, versions[spot_id])
+
+@contextmanager
+def booking_transaction():
+    """Write transaction on the active shard that holds SQLite's write lock from the start
+
+    Checking that a spot is free and inserting the booking must not
+    interleave with another worker process doing the same, so BEGIN
+    IMMEDIATE takes the lock before the check rather than at the insert.
+    """
+    db.session.commit()
+    db.session.connection(bind_arguments={'mapper': AdvanceBooking}).exec_driver_sql('BEGIN IMMEDIATE')
+    try:
+        yield
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+def has_booking_conflict(spot_id, start, end):
+    """Authoritative overlap check for a single spot against the database"""
+    return db.session.query(AdvanceBooking.id).filter(
+        AdvanceBooking.spot_id == spot_id,
+        AdvanceBooking.status.in_(LIVE_BOOKING_STATUSES),
+        AdvanceBooking.end_time > start,
+        AdvanceBooking.start_time < end
+    ).first() is not None
+
+def find_free_spot(spot_ids, start, end):
+    """Pick the first spot free for [start, end): search the index, confirm in the database
+
+    The index is only a hint. Candidates whose bookings changed since it
+    last saw them are reloaded first, so a spot booked, cancelled or moved
+    by another worker is neither offered nor skipped by mistake. Call it
+    inside booking_transaction() so the answer still holds at insert time.
+    """
+    schedule = get_spot_schedule()
+    candidates = list(spot_ids)
+    versions = get_booking_versions(candidates)
+    stale = schedule.stale(versions.items())
+    if stale:
+        refresh_spot_schedule({spot_id: versions[spot_id] for spot_id in stale})
+    while candidates:
+        spot_id = schedule.find_free_spot(candidates, start, end)
+        if spot_id is None:
+            return None
+        if not has_booking_conflict(spot_id, start, end):
+            return spot_id
+        # The index was stale for this spot; resync it and keep looking
+        refresh_spot_schedule(get_booking_versions([spot_id]))
+        candidates = candidates[candidates.index(spot_id) + 1:]
+    return None
+
+def close_checked_in_bookings(reservation_ids):
+    """Mark the checked-in bookings of reservations that just closed as done
+
+    The vehicle has left, so the rest of the booked window is free again.
+    Returns (spot_id, booking_id) rows to drop from the index once committed.
+    """
+    closed = db.session.query(AdvanceBooking.spot_id, AdvanceBooking.id).filter(
+        AdvanceBooking.status == 'I',
+        AdvanceBooking.reservation_id.in_(reservation_ids)
+    ).all()
+    if closed:
+        AdvanceBooking.query.filter(
+            AdvanceBooking.id.in_([booking_id for _, booking_id in closed])
+        ).update({'status': 'D'}, synchronize_session=False)
+    return closed
+
+def sync_reserved_spots(now=None):
+    """Move spots in and out of 'R' as booked windows open and close"""
+    now = now or datetime.now()
+    for _ in shards.each():
+        sync_shard_reserved_spots(now)
+    get_spot_schedule().prune(now)
+
+def sync_shard_reserved_spots(now, spot_ids=None):
+    """Update 'R' holds in the active shard, for every spot or only the given ones"""
+    hold_from = now + timedelta(minutes=RESERVATION_HOLD_MINUTES)
+    lapsed = AdvanceBooking.query.filter(AdvanceBooking.status == 'B', AdvanceBooking.end_time <= now)
+    spots = Spot.query
+    if spot_ids is not None:
+        lapsed = lapsed.filter(AdvanceBooking.spot_id.in_(spot_ids))
+        spots = spots.filter(Spot.id.in_(spot_ids))
+    
+    # Bookings whose window passed without a check-in lapse
+    lapsed.update({'status': 'E'}, synchronize_session=False)
+    
+    held = db.session.query(AdvanceBooking.spot_id).filter(
+        AdvanceBooking.status == 'B',
+        AdvanceBooking.end_time > now,
+        AdvanceBooking.start_time <= hold_from
+    )
+    spots.filter(Spot.status == 'R', ~Spot.id.in_(held)).update({'status': 'A'}, synchronize_session=False)
+    spots.filter(Spot.status == 'A', Spot.id.in_(held)).update({'status': 'R'}, synchronize_session=False)
+    db.session.commit()
+
+# Billing
+def get_lot_tariff(lot_id):
+    """Pricing rules of a lot, or the plain hourly rate if none are set"""
+    settings = db.session.get(LotTariff, lot_id) if lot_id else None
+    if not settings:
+        return FLAT_TARIFF
+    return build_tariff(settings.bands, settings.grace_minutes, settings.daily_cap)
+
+def price_stays(lot_ids, parked, left, rates):
+    """Charges for many stays in one vectorised pass, each under its lot's tariff"""
+    tariffs = {lot_id: FLAT_TARIFF for lot_id in set(lot_ids)}
+    for settings in LotTariff.query.filter(LotTariff.lot_id.in_(tariffs)):
+        tariffs[settings.lot_id] = build_tariff(settings.bands, settings.grace_minutes, settings.daily_cap)
+    return compute_charges(to_minutes(parked), to_minutes(left), rates, [tariffs[lot_id] for lot_id in lot_ids])
+
+def settle_reservations(day, reprice=False):
+    """Price every reservation that ended on `day` across all lots, one vectorised pass per shard
+
+    Only unsettled reservations are priced unless `reprice` is set, in which
+    case the whole day is recomputed under the current tariffs.
+    """
+    totals = {'reservations': 0, 'revenue': 0.0, 'lots': {}}
+    for _ in shards.each():
+        result = settle_shard_reservations(day, reprice)
+        totals['reservations'] += result['reservations']
+        totals['revenue'] += result['revenue']
+        for lot_id, amount in result['lots'].items():
+            totals['lots'][lot_id] = totals['lots'].get(lot_id, 0.0) + amount
+    return totals
+
+def settle_shard_reservations(day, reprice):
+    """Settle the active shard's reservations that ended on `day`"""
+    day_start = datetime(day.year, day.month, day.day)
+    query = db.session.query(
+        Reservation.id, Spot.lot_id, Reservation.parking_timestamp,
+        Reservation.leaving_timestamp, Reservation.parking_cost_per_unit
+    ).outerjoin(Spot, Spot.id == Reservation.spot_id).filter(
+        Reservation.leaving_timestamp >= day_start,
+        Reservation.leaving_timestamp < day_start + timedelta(days=1)
+    )
+    if not reprice:
+        query = query.filter(Reservation.total_cost == None)
+    rows = query.all()
+    if not rows:
+        return {'reservations': 0, 'revenue': 0.0, 'lots': {}}
+    
+    ids, lot_ids, parked, left, rates = zip(*rows)
+    costs = price_stays(lot_ids, parked, left, rates)
+    db.session.execute(db.update(Reservation), [
+        {'id': reservation_id, 'total_cost': float(cost)} for reservation_id, cost in zip(ids, costs)
+    ])
+    db.session.commit()
+    
+    # Revenue per lot for the reconciliation report
+    lots, lot_index = np.unique(np.array([lot_id or 0 for lot_id in lot_ids]), return_inverse=True)
+    revenue = np.bincount(lot_index, weights=costs)
+    return {
+        'reservations': len(ids),
+        'revenue': float(costs.sum()),
+        'lots': {int(lot_id): float(amount) for lot_id, amount in zip(lots, revenue)}
+    }
+
+@app.cli.command('reconcile')
+@click.option('--date', 'day', type=click.DateTime(formats=['%Y-%m-%d']), default=None,
+              help='Day to settle (defaults to yesterday)')
+@click.option('--reprice', is_flag=True, help='Recompute already settled reservations too')
+def reconcile_command(day, reprice):
+    """End-of-day settlement of closed reservations"""
+    day = day or datetime.now() - timedelta(days=1)
+    result = settle_reservations(day.date(), reprice=reprice)
+    click.echo(f"{day:%Y-%m-%d}: settled {result['reservations']} reservations, revenue ₹{result['revenue']:.2f}")
+    for lot_id, amount in sorted(result['lots'].items()):
+        click.echo(f"  Lot {lot_id or '(deleted)'}: ₹{amount:.2f}")
+
+# Overstays
+OVERSTAY_WARNING_HOURS = 12  # Open reservations older than this are flagged and the user warned
+AUTO_RELEASE_HOURS = 24  # ...and older than this are released and billed automatically
+OVERSTAY_BATCH_SIZE = 500  # Rows per write transaction, to keep write locks short
+
+def process_overstays(now=None):
+    """Flag long-running reservations and auto-release abandoned ones, shard by shard"""
+    now = now or datetime.now()
+    totals = {'released': 0, 'flagged': 0}
+    for _ in shards.each():
+        for key, count in process_shard_overstays(now).items():
+            totals[key] += count
+    return totals
+
+def process_shard_overstays(now):
+    """Overstay sweep of the active shard, written in batches"""
+    release_cutoff = now - timedelta(hours=AUTO_RELEASE_HOURS)
+    
+    # One range scan over the (leaving_timestamp, parking_timestamp) index
+    rows = db.session.query(
+        Reservation.id, Spot.lot_id, Reservation.spot_id, Reservation.parking_timestamp,
+        Reservation.parking_cost_per_unit, Reservation.overstay_flagged_at
+    ).outerjoin(Spot, Spot.id == Reservation.spot_id).filter(
+        Reservation.leaving_timestamp == None,
+        Reservation.parking_timestamp < now - timedelta(hours=OVERSTAY_WARNING_HOURS)
+    ).all()
+    db.session.commit()  # End the read transaction before writing
+    
+    to_release = [row for row in rows if row.parking_timestamp < release_cutoff]
+    to_flag = [row.id for row in rows if row.parking_timestamp >= release_cutoff and not row.overstay_flagged_at]
+    reservation_table = Reservation.__table__
+    
+    for i in range(0, len(to_release), OVERSTAY_BATCH_SIZE):
+        batch = to_release[i:i + OVERSTAY_BATCH_SIZE]
+        costs = price_stays([row.lot_id for row in batch], [row.parking_timestamp for row in batch],
+                            [now] * len(batch), [row.parking_cost_per_unit for row in batch])
+        # Skip rows the user released in the meantime
+        db.session.execute(
+            reservation_table.update().where(
+                reservation_table.c.id == db.bindparam('reservation_id'),
+                reservation_table.c.leaving_timestamp == None
+            ).values(leaving_timestamp=now, total_cost=db.bindparam('cost')),
+            [{'reservation_id': row.id, 'cost': float(cost)} for row, cost in zip(batch, costs)]
+        )
+        still_open = db.session.query(Reservation.spot_id).filter(Reservation.leaving_timestamp == None)
+        Spot.query.filter(
+            Spot.id.in_([row.spot_id for row in batch]),
+            Spot.status == 'O',
+            ~Spot.id.in_(still_open)
+        ).update({'status': 'A'}, synchronize_session=False)
+        closed = close_checked_in_bookings([row.id for row in batch])
+        db.session.commit()
+        for spot_id, booking_id in closed:
+            get_spot_schedule().remove(spot_id, booking_id)
+        
+        released = Reservation.query.options(
+            db.selectinload(Reservation.user), db.joinedload(Reservation.spot).joinedload(Spot.lot)
+        ).filter(Reservation.id.in_([row.id for row in batch]), Reservation.leaving_timestamp == now).all()
+        for reservation in released:
+            if reservation.user and reservation.user.email and reservation.spot:
+                duration_hours = (now - reservation.parking_timestamp).total_seconds() / 3600
+                send_release_notification_email(reservation.user, reservation, reservation.spot,
+                                                reservation.spot.lot, reservation.total_cost, duration_hours)
+    
+    for i in range(0, len(to_flag), OVERSTAY_BATCH_SIZE):
+        batch = to_flag[i:i + OVERSTAY_BATCH_SIZE]
+        Reservation.query.filter(
+            Reservation.id.in_(batch),
+            Reservation.leaving_timestamp == None,
+            Reservation.overstay_flagged_at == None
+        ).update({'overstay_flagged_at': now}, synchronize_session=False)
+        db.session.commit()
+        
+        flagged = Reservation.query.options(
+            db.selectinload(Reservation.user), db.joinedload(Reservation.spot).joinedload(Spot.lot)
+        ).filter(Reservation.id.in_(batch), Reservation.overstay_flagged_at == now).all()
+        for reservation in flagged:
+            if reservation.user and reservation.user.email and reservation.spot:
+                release_at = reservation.parking_timestamp + timedelta(hours=AUTO_RELEASE_HOURS)
+                send_overstay_warning_email(reservation.user, reservation, reservation.spot,
+                                            reservation.spot.lot, release_at)
+    
+    return {'released': len(to_release), 'flagged': len(to_flag)}
+
+# Rendered lot cards, keyed on the lot's cache token and version
+def render_lot_cards(kind, lots):
+    """Cards for (lot_id, cache_token, version) rows, re-rendering only lots that changed"""
+    keys = {lot_id: f'{kind}:{lot_id}:{cache_token}:{version}' for lot_id, cache_token, version in lots}
+    cards = {lot_id: fragment_cache.get(key) for lot_id, key in keys.items()}
+    
+    missing = [lot_id for lot_id, card in cards.items() if card is None]
+    for shard in shards.each():
+        shard_missing = [lot_id for lot_id in missing if shards.for_id(lot_id) == shard]
+        if not shard_missing:
+            continue
+        spots_by_lot = {lot_id: [] for lot_id in shard_missing}
+        for spot in Spot.query.filter(Spot.lot_id.in_(shard_missing)).order_by(Spot.id):
+            spots_by_lot[spot.lot_id].append(spot)
+        for lot in Lot.query.filter(Lot.id.in_(shard_missing)):
+            card = render_template(f'partials/{kind}_lot_card.html', lot=lot, spots=spots_by_lot[lot.id])
+            fragment_cache.set(keys[lot.id], card)
+            cards[lot.id] = card
+    
+    return [Markup(cards[lot_id]) for lot_id, _, _ in lots if cards[lot_id] is not None]
+
+# Occupancy analytics
+MAX_ANALYTICS_DAYS = 3 * 366
+MAX_ANALYTICS_BINS = MAX_ANALYTICS_DAYS * 24  # Bins per lot in one window, so 15-minute bins cover at most 274 days
+ANALYTICS_CHUNK_DAYS = 31  # Uncached days computed per pass, to bound the sweep's working arrays
+
+def max_analytics_days(resolution):
+    """Longest window offered at a resolution, so finer bins get shorter windows"""
+    return min(MAX_ANALYTICS_DAYS, MAX_ANALYTICS_BINS * resolution // 1440)
+
+# Closed days only, keyed on (day, resolution); room for the longest window at every resolution
+occupancy_cache = LRUCache(max_entries=sum(max_analytics_days(resolution) for resolution in RESOLUTIONS))
+
+def compute_daily_occupancy(first_day, last_day, resolution):
+    """Per-lot occupancy of each day in [first_day, last_day], in one vectorised pass
+
+    Returns {day: (lot_ids, occupancy)} with one row per lot that had any
+    vehicle parked that day. Open reservations count as parked until now.
+    """
+    range_start = datetime(first_day.year, first_day.month, first_day.day)
+    n_days = (last_day - first_day).days + 1
+    range_end = range_start + timedelta(days=n_days)
+    bins_per_day = 1440 // resolution
+    
+    rows = shards.gather(db.session.query(Spot.lot_id, Reservation.parking_timestamp, Reservation.leaving_timestamp).join(
+        Spot, Spot.id == Reservation.spot_id
+    ).filter(
+        Reservation.parking_timestamp < range_end,
+        db.or_(Reservation.leaving_timestamp == None, Reservation.leaving_timestamp > range_start)
+    ))
+    
+    empty = (np.zeros(0, dtype=np.int64), np.zeros((0, bins_per_day), dtype=np.float32))
+    if not rows:
+        return {first_day + timedelta(days=d): empty for d in range(n_days)}
+    
+    lot_ids, parked, left = zip(*rows)
+    now = datetime.now()
+    lots, lot_index = np.unique(np.array(lot_ids), return_inverse=True)
+    edges = to_minutes([range_start])[0] + np.arange(n_days * bins_per_day + 1) * resolution
+    occupancy = occupancy_series(to_minutes(parked), to_minutes([l or now for l in left]),
+                                 lot_index, len(lots), edges)
+    
+    result = {}
+    for d in range(n_days):
+        day_occupancy = occupancy[:, d * bins_per_day:(d + 1) * bins_per_day]
+        active = day_occupancy.any(axis=1)
+        result[first_day + timedelta(days=d)] = (lots[active], day_occupancy[active].astype(np.float32))
+    return result
+
+def lot_occupancy(first_day, last_day, resolution):
+    """Occupancy of every lot over whole days, computing only days not cached yet
+
+    Returns (lots, occupancy) where lots are (id, name, spot count) rows and
+    occupancy is the average number of parked vehicles per bin.
+    """
+    today = date.today()
+    days = [first_day + timedelta(days=d) for d in range((last_day - first_day).days + 1)]
+    per_day = {day: occupancy_cache.get((day, resolution)) for day in days if day < today}
+    missing = [day for day in days if per_day.get(day) is None]
+    
+    # Compute each run of consecutive missing days on its own, so a missing
+    # today does not drag in every cached day since the oldest gap, and cut
+    # long runs (a cold cache) into chunks to keep the sweep's arrays small
+    runs = []
+    for day in missing:
+        if runs and day - runs[-1][-1] == timedelta(days=1) and len(runs[-1]) < ANALYTICS_CHUNK_DAYS:
+            runs[-1].append(day)
+        else:
+            runs.append([day])
+    for run in runs:
+        computed = compute_daily_occupancy(run[0], run[-1], resolution)
+        for day in run:
+            per_day[day] = computed[day]
+            if day < today:
+                occupancy_cache.set((day, resolution), computed[day])
+    
+    lots = shards.gather(db.session.query(Lot.id, Lot.prime_location_name, db.func.count(Spot.id)).outerjoin(
+        Spot, Spot.lot_id == Lot.id
+    ).group_by(Lot.id).order_by(Lot.id))
+    position = {lot_id: i for i, (lot_id, _, _) in enumerate(lots)}
+    
+    bins_per_day = 1440 // resolution
+    occupancy = np.zeros((len(lots), len(days) * bins_per_day), dtype=np.float32)
+    for d, day in enumerate(days):
+        day_lots, day_occupancy = per_day[day]
+        rows = np.array([position.get(lot_id, -1) for lot_id in day_lots], dtype=np.int64)
+        known = rows >= 0
+        occupancy[rows[known], d * bins_per_day:(d + 1) * bins_per_day] = day_occupancy[known]
+    return lots, occupancy
+
+def parse_analytics_args():
+    """Day range and resolution from the query string, with defaults"""
+    resolution = request.args.get('resolution', 60, type=int)
+    if resolution not in RESOLUTIONS:
+        resolution = 60
+    days = min(max(request.args.get('days', 30, type=int), 1), max_analytics_days(resolution))
+    last_day = date.today()
+    return last_day - timedelta(days=days - 1), last_day, days, resolution
+
+def has_active_reservation(user_id):
+    """True if the user is parked anywhere; their reservations may be in any shard"""
+    for _ in shards.each():
+        if Reservation.query.filter_by(user_id=user_id, leaving_timestamp=None).first():
+            return True
+    return False
+
+def parse_booking_time(value):
+    """Parse a datetime-local form value, returning None if it is invalid"""
+    try:
+        return datetime.strptime(value or '', '%Y-%m-%dT%H:%M')
+    except ValueError:
+        return None
+
+# Background jobs run on one leader process, separate from request handling
+background_jobs = LeaderScheduler(app, [process_overstays, sync_reserved_spots],
+                                  interval=int(os.getenv('SCHEDULER_INTERVAL', '60')))
+if os.getenv('SCHEDULER_ENABLED', 'True') == 'True':
+    background_jobs.start()
+
+@app.before_request
+def reset_shard():
+    """Each request starts on the primary database; views pick their lot's shard"""
+    shards.activate(PRIMARY_SHARD)
+
 @app.route('/', methods=['GET', 'POST'])
 def login():
     """User and Admin Login Route"""
@@ -321,19 +871,9 @@ def admin(id):
         flash('Access denied. Admin login required.', 'danger')
         return redirect(url_for('login'))
     
-    lots = Lot.query.all()
-    lot_spots = []
-    for lot in lots:
-        container = [[lot.id, lot.prime_location_name, lot.address, lot.price]]
-        spots = Spot.query.filter_by(lot_id=lot.id).all()
-        occupied = False
-        for spot in spots:
-            container.append([spot.id, spot.status, spot.vehicle_type])
-            if spot.status == 'O':
-                occupied = True
-        container.append(occupied)
-        lot_spots.append(container)
-    return render_template('admin_home.html', active_tab='home', lot_spots=lot_spots)
+    lots = shards.gather(db.session.query(Lot.id, Lot.cache_token, Lot.version).order_by(Lot.id))
+    lot_cards = render_lot_cards('admin', lots)
+    return render_template('admin_home.html', active_tab='home', lot_cards=lot_cards)
 
 @app.route('/viewSpot')
 def view_spot():
@@ -344,13 +884,29 @@ def view_spot():
     
     spot_id = request.args.get('id')
     status = request.args.get('status')
+    shards.activate(shards.for_id(spot_id))
     
     # Get spot details
     spot = db.session.get(Spot, spot_id)
     
     # Get booking/reservation details if spot is occupied
     booking_info = None
-    if spot and status in ['O', 'R']:
+    if spot and status == 'R':
+        booking = AdvanceBooking.query.filter(
+            AdvanceBooking.spot_id == spot.id,
+            AdvanceBooking.status == 'B',
+            AdvanceBooking.end_time > datetime.now()
+        ).order_by(AdvanceBooking.start_time).first()
+        if booking:
+            booking_info = {
+                'vehicle_number': booking.vehicle_number,
+                'vehicle_type': booking.vehicle_type,
+                'user_name': booking.user.name if booking.user else 'Unknown',
+                'reserved_from': booking.start_time,
+                'reserved_until': booking.end_time,
+                'cost_per_hour': booking.parking_cost_per_unit
+            }
+    elif spot and status == 'O':
         reservation = Reservation.query.filter_by(spot_id=spot_id, leaving_timestamp=None).first()
         if reservation:
             user = db.session.get(User, reservation.user_id)
@@ -372,11 +928,15 @@ def delete_spot():
         return redirect(url_for('login'))
     
     spot_id = request.args.get('id')
+    shards.activate(shards.for_id(spot_id))
     spot = db.session.get(Spot, spot_id)
     if spot:
         # Check if spot is occupied
         reservation = Reservation.query.filter_by(spot_id=spot_id, leaving_timestamp=None).first()
-        if not reservation:
+        upcoming = AdvanceBooking.query.filter_by(spot_id=spot.id, status='B').first()
+        if upcoming:
+            flash('Cannot delete a spot with upcoming advance bookings', 'danger')
+        elif not reservation:
             db.session.delete(spot)
             db.session.commit()
             flash('Spot deleted successfully', 'success')
@@ -385,12 +945,12 @@ def delete_spot():
     return redirect(url_for('admin', id=session['user_id']))
 
 def get_next_available_spot_ids(count):
-    """Get the next available spot IDs, reusing deleted IDs if possible"""
+    """Get the next available spot IDs in the active shard, reusing deleted IDs if possible"""
     # Get all existing spot IDs
     existing_ids = set(spot.id for spot in Spot.query.with_entities(Spot.id).all())
     
     available_ids = []
-    current_id = 1
+    current_id = shards.id_range(shards.current())[0] + 1
     
     # First, try to reuse gaps in the sequence
     while len(available_ids) < count:
@@ -421,6 +981,8 @@ def add_lot():
             flash('Total spots must be greater than 0', 'danger')
             return render_template('add_lot.html')
         
+        # The lot, its spots and their bookings live in the pincode's regional shard
+        shards.activate(shards.for_pincode(pincode))
         lot = Lot(
             prime_location_name=location,
             price=float(price),
@@ -465,6 +1027,7 @@ def delete_lot():
         return redirect(url_for('login'))
     
     lot_id = request.args.get('id')
+    shards.activate(shards.for_id(lot_id))
     
     # Check if any spots in this lot have active reservations (not yet released)
     spots_with_active_reservations = db.session.query(Spot).join(Reservation).filter(
@@ -486,7 +1049,17 @@ def delete_lot():
         flash('Cannot delete lot with occupied spots', 'danger')
         return redirect(url_for('admin', id=session['user_id']))
     
+    upcoming_bookings = db.session.query(AdvanceBooking.id).join(Spot).filter(
+        Spot.lot_id == lot_id,
+        AdvanceBooking.status == 'B'
+    ).first()
+    
+    if upcoming_bookings:
+        flash('Cannot delete lot with upcoming advance bookings', 'danger')
+        return redirect(url_for('admin', id=session['user_id']))
+    
     db.session.query(Spot).filter(Spot.lot_id == lot_id).delete()
+    db.session.query(LotTariff).filter(LotTariff.lot_id == lot_id).delete()
     db.session.query(Lot).filter(Lot.id == lot_id).delete()
     db.session.commit()
     flash('Lot deleted successfully', 'success')
@@ -500,6 +1073,7 @@ def edit_lot():
         return redirect(url_for('login'))
     
     lot_id = request.args.get('id')
+    shards.activate(shards.for_id(lot_id))
     
     if request.method == 'POST':
         maxspot = int(request.form['maxspot'])
@@ -521,7 +1095,9 @@ def edit_lot():
         else:
             # Decrease spots - only delete available ones
             diff = current_count - maxspot
-            available = spots.filter(Spot.status == 'A')
+            # Spots with upcoming advance bookings are kept as well
+            booked = db.session.query(AdvanceBooking.spot_id).filter(AdvanceBooking.status == 'B')
+            available = spots.filter(Spot.status == 'A', ~Spot.id.in_(booked))
             
             if diff > available.count():
                 flash('Cannot reduce spots - not enough available spots', 'danger')
@@ -530,7 +1106,8 @@ def edit_lot():
             # Delete the last 'diff' available spots
             query = db.session.query(Spot.id).filter(
                 Spot.lot_id == lot_id,
-                Spot.status == 'A'
+                Spot.status == 'A',
+                ~Spot.id.in_(booked)
             ).order_by(db.desc(Spot.id)).limit(diff)
             db.session.query(Spot).filter(Spot.id.in_(query)).delete(synchronize_session='fetch')
         
@@ -539,7 +1116,74 @@ def edit_lot():
         return redirect(url_for('admin', id=session['user_id']))
     
     lot = db.session.get(Lot, lot_id)
-    return render_template('edit_lot.html', id=lot_id, lot=lot)
+    return render_template('edit_lot.html', id=lot_id, lot=lot, tariff=lot.tariff if lot else None)
+
+@app.route('/edit_tariff', methods=['POST'])
+def edit_tariff():
+    """Edit parking lot pricing - time bands, grace period and daily cap"""
+    if 'user_id' not in session or not logged_admin(session['user_id']):
+        flash('Access denied. Admin login required.', 'danger')
+        return redirect(url_for('login'))
+    
+    lot_id = request.args.get('id')
+    shards.activate(shards.for_id(lot_id))
+    lot = db.session.get(Lot, lot_id)
+    if not lot:
+        flash('Lot not found', 'danger')
+        return redirect(url_for('admin', id=session['user_id']))
+    
+    bands = request.form.get('bands', '').strip()
+    try:
+        build_tariff(bands)
+        grace_minutes = int(request.form.get('grace_minutes') or 0)
+        daily_cap = parse_daily_cap(request.form.get('daily_cap'))
+    except ValueError as e:
+        flash(f'Invalid pricing: {e}', 'danger')
+        return redirect(url_for('edit_lot', id=lot.id))
+    
+    if not lot.tariff:
+        lot.tariff = LotTariff(lot_id=lot.id)
+    lot.tariff.bands = bands
+    lot.tariff.grace_minutes = max(grace_minutes, 0)
+    lot.tariff.daily_cap = daily_cap
+    db.session.commit()
+    flash('Pricing updated successfully', 'success')
+    return redirect(url_for('edit_lot', id=lot.id))
+
+SEARCH_PAGE_SIZE = 25
+
+def prefix_range(column, prefix):
+    """Index-friendly prefix match: column >= prefix AND column < next prefix"""
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return db.and_(column >= prefix, column < upper)
+
+def get_booking_aggregates(user_ids):
+    """Active spot, total bookings, total spend and last visit per user in one grouped query"""
+    if not user_ids:
+        return {}
+    hours = (db.func.julianday(Reservation.leaving_timestamp) -
+             db.func.julianday(Reservation.parking_timestamp)) * 24
+    rows = shards.gather(db.session.query(
+        Reservation.user_id,
+        db.func.max(db.case((Reservation.leaving_timestamp == None, Reservation.spot_id))),
+        db.func.count(Reservation.id),
+        db.func.coalesce(db.func.sum(
+            db.func.coalesce(Reservation.total_cost, hours * Reservation.parking_cost_per_unit)
+        ), 0),
+        db.func.max(Reservation.parking_timestamp)
+    ).filter(Reservation.user_id.in_(user_ids)).group_by(Reservation.user_id))
+    
+    # A user's bookings may be spread over several shards
+    aggregates = {}
+    for user_id, active_spot, total_bookings, total_spend, last_visit in rows:
+        merged = aggregates.setdefault(user_id, {
+            'active_spot': None, 'total_bookings': 0, 'total_spend': 0, 'last_visit': None
+        })
+        merged['active_spot'] = merged['active_spot'] or active_spot
+        merged['total_bookings'] += total_bookings
+        merged['total_spend'] += total_spend
+        merged['last_visit'] = max(filter(None, [merged['last_visit'], last_visit]), default=None)
+    return aggregates
 
 @app.route('/admin/search', methods=['GET', 'POST'])
 def admin_search():
@@ -549,19 +1193,36 @@ def admin_search():
         return redirect(url_for('login'))
     
     results = []
-    search_query = ''
+    search_query = request.values.get('search', '').strip()
+    after = request.args.get('after', 0, type=int)
+    next_cursor = None
     
-    if request.method == 'POST':
-        search_query = request.form.get('search', '')
-        # Search for users
+    if search_query:
+        # Prefix search on username, name or pincode, each backed by an index
+        term = search_query.lower()
+        # id + 0 keeps the cursor and ordering off the rowid; otherwise SQLite walks
+        # the whole table in id order instead of using the prefix indexes
+        user_order = User.id + 0
         users = User.query.filter(
-            (User.username.contains(search_query)) | 
-            (User.name.contains(search_query)) |
-            (User.pincode.contains(search_query))
-        ).all()
-        results = users
+            db.or_(
+                prefix_range(db.func.lower(User.username), term),
+                prefix_range(db.func.lower(User.name), term),
+                prefix_range(User.pincode, search_query)
+            ),
+            user_order > after
+        ).order_by(user_order).limit(SEARCH_PAGE_SIZE + 1).all()
+        
+        # Keyset cursor: the next page starts after the last id shown
+        if len(users) > SEARCH_PAGE_SIZE:
+            users = users[:SEARCH_PAGE_SIZE]
+            next_cursor = users[-1].id
+        
+        aggregates = get_booking_aggregates([u.id for u in users])
+        empty = {'active_spot': None, 'total_bookings': 0, 'total_spend': 0, 'last_visit': None}
+        results = [{'user': u, **aggregates.get(u.id, empty)} for u in users]
     
-    return render_template('admin_search.html', active_tab='search', results=results, query=search_query)
+    return render_template('admin_search.html', active_tab='search', results=results, query=search_query,
+                           after=after, next_cursor=next_cursor)
 
 @app.route('/admin/summary')
 def admin_summary():
@@ -570,14 +1231,17 @@ def admin_summary():
         flash('Access denied. Admin login required.', 'danger')
         return redirect(url_for('login'))
     
-    total_lots = Lot.query.count()
-    total_spots = Spot.query.count()
-    available_spots = Spot.query.filter_by(status='A').count()
-    occupied_spots = Spot.query.filter_by(status='O').count()
-    reserved_spots = Spot.query.filter_by(status='R').count()
+    total_lots = shards.count(Lot.query)
+    total_spots = shards.count(Spot.query)
+    available_spots = shards.count(Spot.query.filter_by(status='A'))
+    occupied_spots = shards.count(Spot.query.filter_by(status='O'))
+    reserved_spots = shards.count(Spot.query.filter_by(status='R'))
     
-    # Get all reservations
-    reservations = Reservation.query.all()
+    # Most recent reservations: the newest 20 of each shard, merged
+    reservations = shards.gather(Reservation.query.order_by(
+        db.desc(Reservation.parking_timestamp)
+    ).limit(20))
+    reservations = sorted(reservations, key=lambda r: r.parking_timestamp, reverse=True)[:20]
     
     stats = {
         'total_lots': total_lots,
@@ -590,6 +1254,67 @@ def admin_summary():
     
     return render_template('admin_summary.html', active_tab='summary', stats=stats, reservations=reservations)
 
+@app.route('/admin/analytics')
+def admin_analytics():
+    """Admin analytics - peak hours and utilisation per lot"""
+    if 'user_id' not in session or not logged_admin(session['user_id']):
+        flash('Access denied. Admin login required.', 'danger')
+        return redirect(url_for('login'))
+    
+    first_day, last_day, days, resolution = parse_analytics_args()
+    lots, occupancy = lot_occupancy(first_day, last_day, resolution)
+    
+    # Leave out today's bins that have not happened yet
+    start_minute = to_minutes([datetime(first_day.year, first_day.month, first_day.day)])[0]
+    elapsed = int(np.ceil((to_minutes([datetime.now()])[0] - start_minute) / resolution))
+    occupancy = occupancy[:, :elapsed]
+    bin_minutes = start_minute + np.arange(occupancy.shape[1]) * resolution
+    weekdays = (bin_minutes // 1440).astype(np.int64) % 7
+    hours = (bin_minutes % 1440 // 60).astype(np.int64)
+    
+    capacity = np.array([spot_count for _, _, spot_count in lots], dtype=float)
+    heatmap = weekly_heatmap(occupancy, capacity, weekdays, hours)
+    stats = utilisation_stats(occupancy, capacity, hours)
+    lot_stats = [{
+        'id': lot_id,
+        'name': name,
+        'spots': spot_count,
+        'mean': stats['mean'][i] * 100,
+        'p50': stats['percentiles'][i][0] * 100,
+        'p90': stats['percentiles'][i][1] * 100,
+        'p99': stats['percentiles'][i][2] * 100,
+        'max': stats['max'][i] * 100,
+        'peak_hour': int(stats['peak_hour'][i])
+    } for i, (lot_id, name, spot_count) in enumerate(lots)]
+    
+    return render_template('admin_analytics.html', active_tab='analytics', days=days, max_days=MAX_ANALYTICS_DAYS,
+                           resolution=resolution, resolutions=RESOLUTIONS,
+                           resolution_days={minutes: max_analytics_days(minutes) for minutes in RESOLUTIONS},
+                           heatmap=(heatmap * 100).round(1).tolist(),
+                           weekdays=WEEKDAYS, lot_stats=lot_stats)
+
+@app.route('/admin/analytics/series')
+def admin_analytics_series():
+    """Occupancy time series of one lot as JSON"""
+    if 'user_id' not in session or not logged_admin(session['user_id']):
+        return jsonify({'error': 'Admin login required'}), 403
+    
+    lot_id = request.args.get('lot', type=int)
+    first_day, last_day, days, resolution = parse_analytics_args()
+    lots, occupancy = lot_occupancy(first_day, last_day, resolution)
+    position = next((i for i, lot in enumerate(lots) if lot[0] == lot_id), None)
+    if position is None:
+        return jsonify({'error': 'Lot not found'}), 404
+    
+    start = datetime(first_day.year, first_day.month, first_day.day)
+    return jsonify({
+        'lot_id': lot_id,
+        'spots': lots[position][2],
+        'resolution_minutes': resolution,
+        'start': start.isoformat(),
+        'occupancy': occupancy[position].round(3).tolist()
+    })
+
 @app.route('/user/<int:id>', methods=['GET', 'POST'])
 def user(id):
     """User Dashboard - Browse and search parking lots"""
@@ -598,22 +1323,21 @@ def user(id):
         return redirect(url_for('login'))
     
     current_user = get_current_user()
-    lot_spot = []
+    lot_cards = []
     location = ''
     
     if request.method == 'POST':
         location = request.form.get('loc', '')
         # Search by location name or pincode
-        lot_spot = db.session.query(Lot, Spot).join(
-            Spot, Lot.id == Spot.lot_id
-        ).filter(
+        lots = shards.gather(db.session.query(Lot.id, Lot.cache_token, Lot.version).filter(
             db.or_(
                 Lot.prime_location_name.ilike(f'%{location}%'),
                 Lot.pin_code.contains(location)
             )
-        ).all()
+        ).order_by(Lot.id))
+        lot_cards = render_lot_cards('user', lots)
     
-    return render_template('user_home.html', user=current_user.name, active_tab='home', lot_spot=lot_spot, location=location)
+    return render_template('user_home.html', user=current_user.name, active_tab='home', lot_cards=lot_cards, location=location)
 
 @app.route('/book_spot', methods=['POST'])
 def book_spot():
@@ -633,6 +1357,7 @@ def book_spot():
         flash('Vehicle number and type are required', 'danger')
         return redirect(url_for('user', id=session['user_id']))
     
+    shards.activate(shards.for_id(lot_id))
     spot = db.session.get(Spot, spot_id)
     lot = db.session.get(Lot, lot_id)
     
@@ -650,30 +1375,45 @@ def book_spot():
         return redirect(url_for('user', id=session['user_id']))
     
     # Check if user already has an active booking
-    active_booking = Reservation.query.filter_by(
-        user_id=current_user.id,
-        leaving_timestamp=None
-    ).first()
-    
-    if active_booking:
+    if has_active_reservation(current_user.id):
         flash('You already have an active booking. Release it first.', 'warning')
         return redirect(url_for('user', id=session['user_id']))
     
-    # Create reservation
-    reservation = Reservation(
-        spot_id=spot_id,
-        user_id=current_user.id,
-        parking_timestamp=datetime.now(),
-        parking_cost_per_unit=lot.price,
-        vehicle_number=vehicle_number.upper(),
-        vehicle_type=vehicle_type
-    )
-    
-    # Update spot status
-    spot.status = 'O'  # O = Occupied
-    
-    db.session.add(reservation)
-    db.session.commit()
+    # Keep walk-ins off spots that are booked in advance for the next few hours
+    now = datetime.now()
+    walk_in_until = now + timedelta(hours=WALK_IN_BUFFER_HOURS)
+    with booking_transaction():
+        # Re-read under the write lock: another walk-in may have taken the spot since
+        parked = db.session.query(Reservation.spot_id).filter(Reservation.leaving_timestamp == None)
+        taken = spot.status != 'A' or db.session.query(parked.filter(Reservation.spot_id == spot.id).exists()).scalar()
+        if taken or find_free_spot([spot.id], now, walk_in_until) is None:
+            others = [spot_id for (spot_id,) in db.session.query(Spot.id).filter(
+                Spot.lot_id == lot.id,
+                Spot.vehicle_type == vehicle_type,
+                Spot.status == 'A',
+                ~Spot.id.in_(parked)
+            ).order_by(Spot.id).all()]
+            free_spot_id = find_free_spot(others, now, walk_in_until)
+            if free_spot_id is None:
+                flash(f'All {vehicle_type} spots here are taken or reserved for upcoming bookings', 'danger')
+                return redirect(url_for('user', id=session['user_id']))
+            spot = db.session.get(Spot, free_spot_id)
+            spot_id = spot.id
+        
+        # Create reservation
+        reservation = Reservation(
+            spot_id=spot_id,
+            user_id=current_user.id,
+            parking_timestamp=now,
+            parking_cost_per_unit=lot.price,
+            vehicle_number=vehicle_number.upper(),
+            vehicle_type=vehicle_type
+        )
+        
+        # Update spot status
+        spot.status = 'O'  # O = Occupied
+        
+        db.session.add(reservation)
     
     # Send booking confirmation email
     if current_user.email:
@@ -693,6 +1433,7 @@ def release_spot():
     
     if request.method == 'POST':
         reservation_id = request.form.get('reservation_id')
+        shards.activate(shards.for_id(reservation_id))
         
         reservation = db.session.get(Reservation, reservation_id)
         if not reservation:
@@ -703,22 +1444,39 @@ def release_spot():
             flash('Unauthorized', 'danger')
             return redirect(url_for('user_summary'))
         
-        # Update reservation
-        reservation.leaving_timestamp = datetime.now()
-        
-        # Calculate duration and total cost
-        duration = reservation.leaving_timestamp - reservation.parking_timestamp
-        duration_hours = duration.total_seconds() / 3600  # Convert to hours
-        total_cost = duration_hours * reservation.parking_cost_per_unit
-        
-        # Get lot and spot details for email
-        spot = db.session.get(Spot, reservation.spot_id)
-        lot = db.session.get(Lot, spot.lot_id)
-        
-        # Update spot status back to available
-        spot.status = 'A'  # A = Available
+        # Hold the write lock so the overstay job cannot release it in between
+        with booking_transaction():
+            # Submitted from a stale page after the overstay job released it
+            if reservation.leaving_timestamp is not None:
+                flash('This booking has already been released', 'warning')
+                return redirect(url_for('user_summary'))
+            
+            # Update reservation
+            reservation.leaving_timestamp = datetime.now()
+            
+            # Get lot and spot details for billing and email
+            spot = db.session.get(Spot, reservation.spot_id)
+            lot = db.session.get(Lot, spot.lot_id)
+            
+            # Calculate duration and total cost
+            duration = reservation.leaving_timestamp - reservation.parking_timestamp
+            duration_hours = duration.total_seconds() / 3600  # Convert to hours
+            total_cost = compute_charge(reservation.parking_timestamp, reservation.leaving_timestamp,
+                                        reservation.parking_cost_per_unit, get_lot_tariff(lot.id))
+            reservation.total_cost = total_cost
+            
+            # Update spot status back to available, unless someone else is parked there
+            still_open = db.session.query(Reservation.id).filter(
+                Reservation.spot_id == spot.id,
+                Reservation.id != reservation.id,
+                Reservation.leaving_timestamp == None
+            ).first()
+            if still_open is None:
+                spot.status = 'A'  # A = Available
+            closed = close_checked_in_bookings([reservation.id])
         
-        db.session.commit()
+        for closed_spot_id, booking_id in closed:
+            get_spot_schedule().remove(closed_spot_id, booking_id)
         
         # Send release notification email with cost details
         if current_user.email:
@@ -729,6 +1487,206 @@ def release_spot():
     
     return redirect(url_for('user_summary'))
 
+@app.route('/reserve_spot', methods=['POST'])
+def reserve_spot():
+    """Reserve a parking spot in advance for a time window"""
+    if 'user_id' not in session or not logged_user(session['user_id']):
+        flash('Please login to reserve a spot.', 'danger')
+        return redirect(url_for('login'))
+    
+    current_user = get_current_user()
+    lot_id = request.form.get('lot_id')
+    spot_id = request.form.get('spot_id')
+    vehicle_number = request.form.get('vehicle_number')
+    vehicle_type = request.form.get('vehicle_type')
+    start = parse_booking_time(request.form.get('start_time'))
+    end = parse_booking_time(request.form.get('end_time'))
+    
+    # Validate inputs
+    if not vehicle_number or not vehicle_type:
+        flash('Vehicle number and type are required', 'danger')
+        return redirect(url_for('user', id=session['user_id']))
+    
+    now = datetime.now()
+    if not start or not end or end <= start:
+        flash('Please choose a valid time window', 'danger')
+        return redirect(url_for('user', id=session['user_id']))
+    
+    if start < now - timedelta(minutes=1):
+        flash('The reservation must start in the future', 'danger')
+        return redirect(url_for('user', id=session['user_id']))
+    
+    if end - start > timedelta(hours=MAX_BOOKING_HOURS) or start > now + timedelta(days=MAX_ADVANCE_DAYS):
+        flash(f'Reservations can be up to {MAX_BOOKING_HOURS} hours long and {MAX_ADVANCE_DAYS} days ahead', 'danger')
+        return redirect(url_for('user', id=session['user_id']))
+    
+    shards.activate(shards.for_id(lot_id))
+    lot = db.session.get(Lot, lot_id)
+    if not lot:
+        flash('Invalid lot', 'danger')
+        return redirect(url_for('user', id=session['user_id']))
+    
+    # Candidate spots: the requested one, or every spot of this type in the lot
+    candidates = db.session.query(Spot.id).filter(
+        Spot.lot_id == lot.id,
+        Spot.vehicle_type == vehicle_type
+    )
+    if spot_id:
+        candidates = candidates.filter(Spot.id == spot_id)
+    if start < now + timedelta(hours=WALK_IN_BUFFER_HOURS):
+        # Spots occupied right now may not be free in time
+        candidates = candidates.filter(Spot.status.in_(['A', 'R']))
+    candidate_ids = [candidate_id for (candidate_id,) in candidates.order_by(Spot.id).all()]
+    
+    with booking_transaction():
+        free_spot_id = find_free_spot(candidate_ids, start, end)
+        if free_spot_id is None:
+            flash(f'No {vehicle_type} spot is free at {lot.prime_location_name} for that time', 'danger')
+            return redirect(url_for('user', id=session['user_id']))
+        
+        booking = AdvanceBooking(
+            spot_id=free_spot_id,
+            user_id=current_user.id,
+            start_time=start,
+            end_time=end,
+            parking_cost_per_unit=lot.price,
+            vehicle_number=vehicle_number.upper(),
+            vehicle_type=vehicle_type,
+            status='B'
+        )
+        db.session.add(booking)
+    get_spot_schedule().add(free_spot_id, start, end, booking.id)
+    
+    # Hold the spot now if the window is about to start; the scheduler handles the rest
+    sync_shard_reserved_spots(datetime.now(), [free_spot_id])
+    flash(f'Spot {free_spot_id} reserved from {start:%Y-%m-%d %H:%M} to {end:%Y-%m-%d %H:%M}', 'success')
+    return redirect(url_for('user_summary'))
+
+@app.route('/check_in', methods=['POST'])
+def check_in():
+    """Start parking on an advance reservation"""
+    if 'user_id' not in session or not logged_user(session['user_id']):
+        flash('Please login to check in.', 'danger')
+        return redirect(url_for('login'))
+    
+    current_user = get_current_user()
+    booking_id = request.form.get('booking_id')
+    shards.activate(shards.for_id(booking_id))
+    booking = db.session.get(AdvanceBooking, booking_id)
+    
+    if not booking or booking.user_id != current_user.id or booking.status != 'B':
+        flash('Reservation not found', 'danger')
+        return redirect(url_for('user_summary'))
+    
+    now = datetime.now()
+    if now < booking.start_time - timedelta(minutes=RESERVATION_HOLD_MINUTES):
+        flash(f'Check-in opens {RESERVATION_HOLD_MINUTES} minutes before your reservation starts', 'warning')
+        return redirect(url_for('user_summary'))
+    
+    if now >= booking.end_time:
+        flash('This reservation has expired', 'danger')
+        return redirect(url_for('user_summary'))
+    
+    if has_active_reservation(current_user.id):
+        flash('You already have an active booking. Release it first.', 'warning')
+        return redirect(url_for('user_summary'))
+    
+    spot = booking.spot
+    if spot.status not in ['A', 'R']:
+        # The previous vehicle has not left yet: move to another free spot of the same type
+        others = [spot_id for (spot_id,) in db.session.query(Spot.id).filter(
+            Spot.lot_id == spot.lot_id,
+            Spot.vehicle_type == booking.vehicle_type,
+            Spot.status == 'A'
+        ).order_by(Spot.id).all()]
+        old_spot_id = booking.spot_id
+        with booking_transaction():
+            free_spot_id = find_free_spot(others, now, booking.end_time)
+            if free_spot_id is None:
+                flash('Your spot is still occupied and no other spot is free. Please contact the attendant.', 'danger')
+                return redirect(url_for('user_summary'))
+            booking.spot_id = free_spot_id
+        get_spot_schedule().remove(old_spot_id, booking.id)
+        get_spot_schedule().add(free_spot_id, booking.start_time, booking.end_time, booking.id)
+        spot = db.session.get(Spot, free_spot_id)
+    
+    reservation = Reservation(
+        spot_id=spot.id,
+        user_id=current_user.id,
+        parking_timestamp=now,
+        parking_cost_per_unit=booking.parking_cost_per_unit,
+        vehicle_number=booking.vehicle_number,
+        vehicle_type=booking.vehicle_type
+    )
+    db.session.add(reservation)
+    db.session.flush()
+    
+    spot.status = 'O'
+    booking.status = 'I'
+    booking.reservation_id = reservation.id
+    db.session.commit()
+    
+    if current_user.email:
+        send_booking_confirmation_email(current_user, reservation, spot, spot.lot)
+    
+    flash(f'Checked in to spot {spot.id}', 'success')
+    return redirect(url_for('user_summary'))
+
+@app.route('/cancel_booking', methods=['POST'])
+def cancel_booking():
+    """Cancel an advance reservation that has not started"""
+    if 'user_id' not in session or not logged_user(session['user_id']):
+        flash('Please login to cancel a reservation.', 'danger')
+        return redirect(url_for('login'))
+    
+    current_user = get_current_user()
+    booking_id = request.form.get('booking_id')
+    shards.activate(shards.for_id(booking_id))
+    booking = db.session.get(AdvanceBooking, booking_id)
+    
+    if not booking or booking.user_id != current_user.id or booking.status != 'B':
+        flash('Reservation not found', 'danger')
+        return redirect(url_for('user_summary'))
+    
+    booking.status = 'C'
+    db.session.commit()
+    get_spot_schedule().remove(booking.spot_id, booking.id)
+    sync_shard_reserved_spots(datetime.now(), [booking.spot_id])
+    
+    flash('Reservation cancelled', 'success')
+    return redirect(url_for('user_summary'))
+
+def summarize_reservation(reservation):
+    """Precompute location, duration and cost of a reservation for display"""
+    spot = reservation.spot
+    location = spot.lot.prime_location_name if spot and spot.lot else None
+    duration_hours = None
+    total_cost = None
+    if reservation.leaving_timestamp:
+        duration = reservation.leaving_timestamp - reservation.parking_timestamp
+        duration_hours = duration.total_seconds() / 3600
+        total_cost = reservation.total_cost
+        if total_cost is None:
+            # Closed before settlement was recorded: plain hourly rate
+            total_cost = compute_charge(reservation.parking_timestamp, reservation.leaving_timestamp,
+                                        reservation.parking_cost_per_unit)
+    return {
+        'reservation': reservation,
+        'location': location,
+        'duration_hours': duration_hours,
+        'total_cost': total_cost
+    }
+
+SUMMARY_PER_PAGE = 20
+
+def parse_history_cursor(value):
+    """(parking_timestamp, id) from a booking history cursor, or None if missing or invalid"""
+    try:
+        timestamp, reservation_id = value.rsplit('_', 1)
+        return datetime.fromisoformat(timestamp), int(reservation_id)
+    except (AttributeError, ValueError):
+        return None
+
 @app.route('/user/summary')
 def user_summary():
     """User Booking Summary - View booking history"""
@@ -737,10 +1695,52 @@ def user_summary():
         return redirect(url_for('login'))
     
     current_user = get_current_user()
-    # Get all reservations for current user
-    reservations = Reservation.query.filter_by(user_id=current_user.id).all()
+    page = request.args.get('page', 1, type=int)
+    with_location = db.joinedload(Reservation.spot).joinedload(Spot.lot)
+    
+    # Active booking(s) with spot and lot loaded in the same query, from every shard
+    active = shards.gather(Reservation.query.options(with_location).filter(
+        Reservation.user_id == current_user.id,
+        Reservation.leaving_timestamp == None
+    ))
+    
+    # Completed bookings, newest first, one page at a time
+    history = Reservation.query.options(with_location).filter(
+        Reservation.user_id == current_user.id,
+        Reservation.leaving_timestamp != None
+    )
+    pagination = before = next_cursor = None
+    if len(shards.ids) == 1:
+        pagination = history.order_by(db.desc(Reservation.parking_timestamp)).paginate(
+            page=page, per_page=SUMMARY_PER_PAGE, error_out=False
+        )
+        history_items, history_total = pagination.items, pagination.total
+    else:
+        # Merging numbered pages would read every earlier page from each shard,
+        # so across shards the history continues from a keyset cursor instead
+        before = parse_history_cursor(request.args.get('before'))
+        history_items, cursor = shards.gather_page(
+            history, (Reservation.parking_timestamp, Reservation.id), SUMMARY_PER_PAGE, before
+        )
+        history_total = shards.count(history)
+        if cursor:
+            next_cursor = f'{cursor[0].isoformat()}_{cursor[1]}'
     
-    return render_template('user_summary.html', active_tab='summary', user=current_user.name, reservations=reservations)
+    # Advance reservations that have not been checked in yet
+    upcoming_bookings = sorted(shards.gather(AdvanceBooking.query.options(
+        db.joinedload(AdvanceBooking.spot).joinedload(Spot.lot)
+    ).filter(
+        AdvanceBooking.user_id == current_user.id,
+        AdvanceBooking.status == 'B'
+    ).order_by(AdvanceBooking.start_time)), key=lambda b: b.start_time)
+    
+    active_reservations = [summarize_reservation(r) for r in active]
+    reservations = [summarize_reservation(r) for r in history_items]
+    
+    return render_template('user_summary.html', active_tab='summary', user=current_user.name,
+                           active_reservations=active_reservations, reservations=reservations,
+                           pagination=pagination, history_total=history_total, before=before,
+                           next_cursor=next_cursor, upcoming_bookings=upcoming_bookings)
 
 @app.route('/logout')
 def logout():
@@ -764,6 +1764,12 @@ def page_not_found(e):
     """Handle 404 errors"""
     return render_template('404.html'), 404
 
+@app.errorhandler(UnknownShardError)
+def unknown_shard(e):
+    """Handle ids from a shard missing from PARKING_SHARDS"""
+    print(f"Error routing request: {e}")
+    return render_template('404.html'), 404
+
 @app.errorhandler(500)
 def internal_error(e):
     """Handle 500 errors"""
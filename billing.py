@@ -0,0 +1,183 @@
+from datetime import datetime
+from functools import lru_cache
+import math
+import numpy as np
+
+# Weekly tables are aligned to a Monday midnight
+EPOCH = datetime(2024, 1, 1)
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+WEEKDAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+
+
+class Tariff:
+    """Time-of-day/weekday pricing for a lot.
+
+    Bands scale the hourly rate locked in at booking time, e.g. a 1.5
+    multiplier on weekday evenings. The weekly multiplier table has one
+    entry per minute, and its running sum turns the cost of any interval
+    into two lookups.
+    """
+
+    def __init__(self, bands=(), grace_minutes=0, daily_cap=None):
+        multipliers = np.ones(MINUTES_PER_WEEK)
+        for weekdays, start_minute, end_minute, multiplier in bands:
+            for day in weekdays:
+                offset = day * MINUTES_PER_DAY
+                if start_minute < end_minute:
+                    multipliers[offset + start_minute:offset + end_minute] = multiplier
+                else:
+                    # Overnight band, e.g. 22:00-06:00, runs into the next day
+                    multipliers[offset + start_minute:offset + MINUTES_PER_DAY] = multiplier
+                    next_offset = (day + 1) % 7 * MINUTES_PER_DAY
+                    multipliers[next_offset:next_offset + end_minute] = multiplier
+        self.multipliers = multipliers
+        # Multiplier-hours accumulated from the start of the week
+        self.cumulative = np.concatenate(([0.0], np.cumsum(multipliers) / 60))
+        self.grace_minutes = grace_minutes
+        self.daily_cap = daily_cap
+
+
+FLAT_TARIFF = Tariff()
+
+
+def parse_time(value):
+    """Minutes after midnight for an 'HH:MM' string (24:00 allowed)"""
+    try:
+        hours, minutes = (int(part) for part in value.split(':'))
+    except ValueError:
+        raise ValueError(f'invalid time "{value}"')
+    total = hours * 60 + minutes
+    if not 0 <= minutes < 60 or not 0 <= total <= MINUTES_PER_DAY:
+        raise ValueError(f'invalid time "{value}"')
+    return total
+
+
+def parse_weekdays(value):
+    """Weekday numbers for 'Mon', 'Mon-Fri', 'Sat,Sun' or 'Daily'"""
+    if value.lower() == 'daily':
+        return list(range(7))
+    days = []
+    for part in value.split(','):
+        names = part.split('-')
+        try:
+            indexes = [WEEKDAYS.index(name.strip().title()[:3]) for name in names]
+        except ValueError:
+            raise ValueError(f'invalid weekday "{part}"')
+        if len(indexes) == 1:
+            days.append(indexes[0])
+        else:
+            first, last = indexes[0], indexes[-1]
+            days.extend(day % 7 for day in range(first, last + 1 if last >= first else last + 8))
+    return days
+
+
+def parse_bands(text):
+    """Parse one band per line: '<days> <HH:MM>-<HH:MM> <multiplier>'
+
+    For example 'Mon-Fri 08:00-20:00 1.5' or 'Daily 22:00-06:00 0.5'.
+    Later lines override earlier ones where they overlap.
+    """
+    bands = []
+    for number, line in enumerate((text or '').splitlines(), start=1):
+        line = line.strip()
+        if not line:
+            continue
+        parts = line.split()
+        if len(parts) != 3 or parts[1].count('-') != 1:
+            raise ValueError(f'Line {number}: expected "<days> <HH:MM>-<HH:MM> <multiplier>"')
+        days, hours, multiplier = parts
+        start, end = hours.split('-')
+        try:
+            multiplier = float(multiplier)
+            if not math.isfinite(multiplier) or multiplier < 0:
+                raise ValueError('multiplier must be a finite number, 0 or more')
+            bands.append((parse_weekdays(days), parse_time(start), parse_time(end), multiplier))
+        except ValueError as e:
+            raise ValueError(f'Line {number}: {e}')
+    return bands
+
+
+def parse_daily_cap(value):
+    """Daily cap as a positive amount, or None for no cap"""
+    value = (value or '').strip()
+    if not value:
+        return None
+    try:
+        cap = float(value)
+    except ValueError:
+        raise ValueError(f'invalid daily cap "{value}"')
+    if not math.isfinite(cap) or cap <= 0:
+        raise ValueError(f'invalid daily cap "{value}", expected an amount above 0')
+    return cap
+
+
+@lru_cache(maxsize=256)
+def build_tariff(bands_text='', grace_minutes=0, daily_cap=None):
+    """Cached Tariff for a lot's stored pricing settings"""
+    # A cap saved before caps were validated is ignored rather than billed
+    if daily_cap is not None and not (math.isfinite(daily_cap) and daily_cap > 0):
+        daily_cap = None
+    return Tariff(parse_bands(bands_text), grace_minutes or 0, daily_cap)
+
+
+def to_minutes(times):
+    """Minutes since EPOCH for a sequence of datetimes, as a float array"""
+    stamps = np.array(times, dtype='datetime64[us]')
+    return (stamps - np.datetime64(EPOCH, 'us')) / np.timedelta64(1, 'm')
+
+
+def _weighted_hours(cumulative, rows, minutes):
+    """Multiplier-hours from EPOCH up to each minute, using tariff row `rows`"""
+    weeks, offset = np.divmod(minutes, MINUTES_PER_WEEK)
+    index = np.minimum(offset.astype(np.int64), MINUTES_PER_WEEK - 1)
+    lower = cumulative[rows, index]
+    upper = cumulative[rows, index + 1]
+    return weeks * cumulative[rows, -1] + lower + (offset - index) * (upper - lower)
+
+
+def compute_charges(starts, ends, base_rates, tariffs):
+    """Vectorised charges for many stays at once.
+
+    starts/ends are minutes since EPOCH, base_rates the hourly rate of each
+    stay and tariffs the Tariff that applies to each stay. Each stay is split
+    into calendar days so the daily cap is applied per day. Stays within their
+    grace period cost nothing.
+    """
+    starts = np.asarray(starts, dtype=float)
+    ends = np.maximum(np.asarray(ends, dtype=float), starts)
+    base_rates = np.asarray(base_rates, dtype=float)
+    n = len(starts)
+    if n == 0:
+        return np.zeros(0)
+
+    # Stack the distinct tariffs once and index them per stay
+    unique = {}
+    tariff_index = np.array([unique.setdefault(id(t), (len(unique), t))[0] for t in tariffs], dtype=np.int64)
+    table = [t for _, t in sorted(unique.values(), key=lambda item: item[0])]
+    cumulative = np.stack([t.cumulative for t in table])
+    grace = np.array([t.grace_minutes for t in table], dtype=float)[tariff_index]
+    caps = np.array([np.inf if t.daily_cap is None else t.daily_cap for t in table])[tariff_index]
+
+    # Expand every stay into one segment per calendar day it touches
+    first_day = np.floor(starts / MINUTES_PER_DAY).astype(np.int64)
+    last_day = np.maximum(np.ceil(ends / MINUTES_PER_DAY).astype(np.int64) - 1, first_day)
+    counts = last_day - first_day + 1
+    stay = np.repeat(np.arange(n), counts)
+    day = first_day[stay] + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    seg_start = np.maximum(starts[stay], day * MINUTES_PER_DAY)
+    seg_end = np.minimum(ends[stay], (day + 1) * MINUTES_PER_DAY)
+
+    rows = tariff_index[stay]
+    hours = _weighted_hours(cumulative, rows, seg_end) - _weighted_hours(cumulative, rows, seg_start)
+    day_costs = np.minimum(hours * base_rates[stay], caps[stay])
+
+    costs = np.bincount(stay, weights=day_costs, minlength=n)
+    costs[ends - starts <= grace] = 0.0
+    return costs
+
+
+def compute_charge(start, end, base_rate, tariff=FLAT_TARIFF):
+    """Charge for a single stay; same rules as compute_charges()"""
+    minutes = to_minutes([start, end])
+    return float(compute_charges(minutes[:1], minutes[1:], [base_rate], [tariff])[0])
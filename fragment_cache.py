@@ -0,0 +1,81 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Lock
+import sqlite3
+import time
+
+
+class LRUCache:
+    """In-process cache that evicts the least recently used fragment"""
+
+    def __init__(self, max_entries=2048):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SQLiteCache:
+    """Cache in a small SQLite file, shared by every worker process on the host"""
+
+    def __init__(self, path, max_entries=20000, prune_every=200):
+        self.path = path
+        self.max_entries = max_entries
+        self.prune_every = prune_every
+        self._writes = 0
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS fragment (key TEXT PRIMARY KEY, value TEXT, stored_at REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_fragment_stored_at ON fragment (stored_at)')
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, key):
+        with self._connect() as conn:
+            row = conn.execute('SELECT value FROM fragment WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, value):
+        with self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO fragment (key, value, stored_at) VALUES (?, ?, ?)',
+                         (key, value, time.time()))
+            self._writes += 1
+            if self._writes % self.prune_every == 0:
+                # Keys carry a version, so old fragments are never read again; drop the oldest
+                conn.execute('DELETE FROM fragment WHERE key IN '
+                             '(SELECT key FROM fragment ORDER BY stored_at DESC LIMIT -1 OFFSET ?)',
+                             (self.max_entries,))
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM fragment')
+
+
+def create_cache(backend, path=None):
+    """Cache backend by name: 'memory' (default) or 'sqlite'"""
+    if backend == 'sqlite':
+        return SQLiteCache(path)
+    return LRUCache()
@@ -1,7 +1,9 @@
 from flask_sqlalchemy import SQLAlchemy
+from sharding import ShardRoutingSession
+import uuid
 from werkzeug.security import generate_password_hash, check_password_hash
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': ShardRoutingSession})
 
 # User class
 class User(db.Model):
@@ -22,6 +24,11 @@ class User(db.Model):
         """Check if provided password matches stored hash"""
         return check_password_hash(self.password_hash, password)
 
+# Expression indexes so admin search can do case-insensitive prefix ranges
+db.Index('ix_user_username_lower', db.func.lower(User.username))
+db.Index('ix_user_name_lower', db.func.lower(User.name))
+db.Index('ix_user_pincode', User.pincode)
+
 # Admin class
 class Admin(db.Model):
     __tablename__ = "admin"
@@ -32,14 +39,44 @@ class Admin(db.Model):
 #Parking Lot class
 class Lot(db.Model):
     __tablename__='lot'
+    __table_args__ = {'sqlite_autoincrement': True}  # Ids stay within the shard's range
     id = db.Column(db.Integer, primary_key=True,autoincrement=True)
     prime_location_name = db.Column(db.String(100), nullable=False)
     price = db.Column(db.Float, nullable=False)
     address = db.Column(db.String(255), nullable=False)
     pin_code = db.Column(db.String(6), nullable=False)
     maximum_number_of_spots = db.Column(db.Integer, nullable=False)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')  # Bumped by LOT_VERSION_TRIGGERS
+    cache_token = db.Column(db.String(32), nullable=False, default=lambda: uuid.uuid4().hex)  # New for every lot, even if its id is reused
 
     spots = db.relationship('Spot', backref='lot',cascade="all, delete-orphan")
+    tariff = db.relationship('LotTariff', backref='lot', uselist=False, cascade="all, delete-orphan")
+
+# Bump a lot's version whenever it is edited or any of its spots is added,
+# removed or changes status. Triggers also catch bulk query updates.
+LOT_VERSION_TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS lot_version_on_edit AFTER UPDATE ON lot
+       WHEN OLD.version = NEW.version
+       BEGIN UPDATE lot SET version = version + 1 WHERE id = NEW.id; END""",
+    """CREATE TRIGGER IF NOT EXISTS lot_version_on_spot_insert AFTER INSERT ON spot
+       BEGIN UPDATE lot SET version = version + 1 WHERE id = NEW.lot_id; END""",
+    """CREATE TRIGGER IF NOT EXISTS lot_version_on_spot_delete AFTER DELETE ON spot
+       BEGIN UPDATE lot SET version = version + 1 WHERE id = OLD.lot_id; END""",
+    """CREATE TRIGGER IF NOT EXISTS lot_version_on_spot_update AFTER UPDATE OF status, vehicle_type, lot_id ON spot
+       WHEN OLD.status IS NOT NEW.status OR OLD.vehicle_type IS NOT NEW.vehicle_type OR OLD.lot_id IS NOT NEW.lot_id
+       BEGIN
+           UPDATE lot SET version = version + 1 WHERE id = NEW.lot_id;
+           UPDATE lot SET version = version + 1 WHERE id = OLD.lot_id AND OLD.lot_id IS NOT NEW.lot_id;
+       END""",
+]
+
+# Lot pricing rules on top of the hourly rate
+class LotTariff(db.Model):
+    __tablename__ = 'lot_tariff'
+    lot_id = db.Column(db.Integer, db.ForeignKey('lot.id'), primary_key=True)
+    grace_minutes = db.Column(db.Integer, nullable=False, default=0)  # Stays this short are free
+    daily_cap = db.Column(db.Float, nullable=True)  # Maximum charge per calendar day
+    bands = db.Column(db.Text, nullable=False, default='')  # One '<days> <HH:MM>-<HH:MM> <multiplier>' per line
 
 # Parking spot class
 class Spot(db.Model):
@@ -48,6 +85,7 @@ class Spot(db.Model):
     lot_id = db.Column(db.Integer, db.ForeignKey('lot.id'), nullable=False)
     status = db.Column(db.String(1), nullable=False, default='A')  # A=Available, O=Occupied, R=Reserved
     vehicle_type = db.Column(db.String(20), nullable=False, default='Two-Wheeler')  # Two-Wheeler or Four-Wheeler
+    booking_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # Bumped by BOOKING_VERSION_TRIGGERS
 
     reservation = db.relationship('Reservation', backref='spot', uselist=False, cascade="all, delete-orphan")
     
@@ -55,6 +93,14 @@ class Spot(db.Model):
 class Reservation(db.Model):
     """Booking/Reservation model for parking spots"""
     __tablename__ = 'reservation'
+    __table_args__ = (
+        # Serves the per-user active booking lookup and history pagination
+        db.Index('ix_reservation_user_parking', 'user_id', 'parking_timestamp'),
+        db.Index('ix_reservation_spot_leaving', 'spot_id', 'leaving_timestamp'),
+        # Serves end-of-day settlement by leaving time and the overstay sweep of open reservations
+        db.Index('ix_reservation_leaving_parking', 'leaving_timestamp', 'parking_timestamp'),
+        {'sqlite_autoincrement': True}
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     spot_id = db.Column(db.Integer, db.ForeignKey('spot.id'), nullable=False)
@@ -62,8 +108,60 @@ class Reservation(db.Model):
     parking_timestamp = db.Column(db.DateTime, nullable=False)
     leaving_timestamp = db.Column(db.DateTime, nullable=True) 
     parking_cost_per_unit = db.Column(db.Float, nullable=False)
+    total_cost = db.Column(db.Float, nullable=True)  # Set when the reservation is settled
+    overstay_flagged_at = db.Column(db.DateTime, nullable=True)  # Set when the user was warned about an overstay
     vehicle_number = db.Column(db.String(20), nullable=False)  # Vehicle registration number
     vehicle_type = db.Column(db.String(20), nullable=False)  # Two-Wheeler or Four-Wheeler
     
     # Relationships
-    
\ No newline at end of file
+    
+
+class AdvanceBooking(db.Model):
+    """Advance reservation of a spot for a future time window"""
+    __tablename__ = 'advance_booking'
+    __table_args__ = (
+        # Future windows of a spot, for the authoritative conflict check
+        db.Index('ix_advance_booking_spot_end', 'spot_id', 'end_time'),
+        db.Index('ix_advance_booking_status_end', 'status', 'end_time'),
+        db.Index('ix_advance_booking_user_status', 'user_id', 'status'),
+        {'sqlite_autoincrement': True}
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    spot_id = db.Column(db.Integer, db.ForeignKey('spot.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    start_time = db.Column(db.DateTime, nullable=False)
+    end_time = db.Column(db.DateTime, nullable=False)
+    parking_cost_per_unit = db.Column(db.Float, nullable=False)
+    vehicle_number = db.Column(db.String(20), nullable=False)
+    vehicle_type = db.Column(db.String(20), nullable=False)
+    status = db.Column(db.String(1), nullable=False, default='B')  # B=Booked, I=Checked in, D=Done, C=Cancelled, E=Expired
+    reservation_id = db.Column(db.Integer, db.ForeignKey('reservation.id'), nullable=True)  # Set on check-in
+
+    # Relationships
+    spot = db.relationship('Spot')
+    user = db.relationship('User')
+
+# Bump a spot's booking_version whenever one of its advance bookings is added,
+# moved or changes status, so every worker can tell its index is out of date
+BOOKING_VERSION_TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS spot_booking_version_on_insert AFTER INSERT ON advance_booking
+       BEGIN UPDATE spot SET booking_version = booking_version + 1 WHERE id = NEW.spot_id; END""",
+    """CREATE TRIGGER IF NOT EXISTS spot_booking_version_on_delete AFTER DELETE ON advance_booking
+       BEGIN UPDATE spot SET booking_version = booking_version + 1 WHERE id = OLD.spot_id; END""",
+    """CREATE TRIGGER IF NOT EXISTS spot_booking_version_on_update
+       AFTER UPDATE OF spot_id, status, start_time, end_time ON advance_booking
+       BEGIN
+           UPDATE spot SET booking_version = booking_version + 1 WHERE id = NEW.spot_id;
+           UPDATE spot SET booking_version = booking_version + 1 WHERE id = OLD.spot_id AND OLD.spot_id IS NOT NEW.spot_id;
+       END""",
+]
+
+
+class SchedulerLease(db.Model):
+    """Leader lock so only one process runs a background job"""
+    __tablename__ = 'scheduler_lease'
+
+    name = db.Column(db.String(50), primary_key=True)
+    owner = db.Column(db.String(100), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
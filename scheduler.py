@@ -0,0 +1,86 @@
+from datetime import datetime, timedelta
+from threading import Thread, Event
+from sqlalchemy.exc import IntegrityError
+from models import db, SchedulerLease
+import os
+import socket
+import uuid
+
+
+def acquire_lease(name, owner, ttl):
+    """Take or renew the named lease; True if `owner` now holds it"""
+    now = datetime.now()
+    renewed = SchedulerLease.query.filter(
+        SchedulerLease.name == name,
+        db.or_(SchedulerLease.owner == owner, SchedulerLease.expires_at < now)
+    ).update({'owner': owner, 'expires_at': now + ttl}, synchronize_session=False)
+    if not renewed:
+        # Either nobody has taken the lease yet, or someone else holds it
+        db.session.add(SchedulerLease(name=name, owner=owner, expires_at=now + ttl))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            return False
+        return True
+    db.session.commit()
+    return True
+
+
+def release_lease(name, owner):
+    """Give up the lease so another process can take over straight away"""
+    SchedulerLease.query.filter_by(name=name, owner=owner).delete()
+    db.session.commit()
+
+
+class LeaderScheduler:
+    """Runs jobs periodically on a daemon thread, outside the request workers.
+
+    Every process may start one, but a job round only runs while this process
+    holds the database lease, so exactly one instance does the work. The lease
+    outlives a few missed ticks, so a crashed leader is replaced soon after.
+    """
+
+    def __init__(self, app, jobs, interval=60, name='background-jobs'):
+        self.app = app
+        self.jobs = jobs
+        self.interval = interval
+        self.name = name
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self.lease_ttl = timedelta(seconds=interval * 3)
+        self._stop = Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self.app.app_context():
+            release_lease(self.name, self.owner)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.tick()
+            self._stop.wait(self.interval)
+
+    def tick(self):
+        """Run one round of jobs if this process is the leader"""
+        with self.app.app_context():
+            try:
+                if not acquire_lease(self.name, self.owner, self.lease_ttl):
+                    return False
+                for job in self.jobs:
+                    job()
+                return True
+            except Exception as e:
+                db.session.rollback()
+                print(f"Error in background job: {e}")
+                return False
+            finally:
+                db.session.remove()
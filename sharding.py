@@ -0,0 +1,159 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from flask_sqlalchemy.session import Session
+import sqlalchemy as sa
+
+# Lots and everything hanging off them live in the lot's regional shard;
+# users, admins and scheduler leases stay in the primary database
+SHARDED_TABLES = {'lot', 'lot_tariff', 'spot', 'reservation', 'advance_booking'}
+PRIMARY_SHARD = 0
+ID_SPAN = 10 ** 9  # Shard n allocates ids in [n * ID_SPAN, (n + 1) * ID_SPAN), so an id names its shard
+
+_current_shard = ContextVar('current_shard', default=PRIMARY_SHARD)
+
+
+class UnknownShardError(LookupError):
+    """An id was allocated by a shard that is not configured"""
+
+
+class ShardRouter:
+    """Maps pincodes and row ids to shards and tracks the active shard.
+
+    Shard 0 is the primary database (SQLALCHEMY_DATABASE_URI). It keeps every
+    lot created before sharding was configured and any pincode no region
+    claims. Regional shards are the binds 'shard1', 'shard2', ...
+    """
+
+    def __init__(self):
+        self.prefixes = {}
+        self.ids = [PRIMARY_SHARD]
+
+    def configure(self, spec):
+        """Parse '<shard>:<prefix>,<prefix>=<uri>;...' and return the matching SQLALCHEMY_BINDS
+
+        For example '1:11,12=sqlite:///north.db;2:60,61=sqlite:///south.db'
+        sends lots with pincodes starting 11 or 12 to shard 1 in north.db.
+        The longest matching prefix wins. Shard numbers are part of every id
+        the shard allocates, so a shard must keep its number for good.
+        """
+        binds = {}
+        self.prefixes = {}
+        self.ids = [PRIMARY_SHARD]
+        for entry in filter(None, (part.strip() for part in (spec or '').split(';'))):
+            shard, colon, rest = entry.partition(':')
+            prefixes, sep, uri = rest.partition('=')
+            if not colon or not sep or not uri.strip() or not shard.strip().isdigit():
+                raise ValueError(f'invalid shard "{entry}", expected "<shard>:<prefix>,<prefix>=<uri>"')
+            shard = int(shard)
+            if shard == PRIMARY_SHARD or shard in self.ids:
+                raise ValueError(f'shard {shard} is the primary database or listed twice')
+            self.ids.append(shard)
+            binds[self.bind_key(shard)] = uri.strip()
+            for prefix in filter(None, (p.strip() for p in prefixes.split(','))):
+                self.prefixes[prefix] = shard
+        self.ids.sort()
+        return binds
+
+    @staticmethod
+    def bind_key(shard):
+        return None if shard == PRIMARY_SHARD else f'shard{shard}'
+
+    def for_pincode(self, pincode):
+        """Shard of the longest configured prefix of the pincode"""
+        pincode = (pincode or '').strip()
+        for length in range(len(pincode), 0, -1):
+            shard = self.prefixes.get(pincode[:length])
+            if shard is not None:
+                return shard
+        return PRIMARY_SHARD
+
+    def for_id(self, row_id):
+        """Shard that allocated a lot, spot, reservation or booking id
+
+        Ids that are not numbers go to the primary database, where they find
+        nothing. Ids from a shard that is no longer configured raise
+        UnknownShardError rather than being looked up in the wrong file.
+        """
+        try:
+            shard = int(row_id) // ID_SPAN
+        except (TypeError, ValueError):
+            return PRIMARY_SHARD
+        if shard not in self.ids:
+            raise UnknownShardError(f'id {row_id} belongs to shard {shard}, which is not in PARKING_SHARDS')
+        return shard
+
+    @staticmethod
+    def id_range(shard):
+        return shard * ID_SPAN, (shard + 1) * ID_SPAN
+
+    @staticmethod
+    def current():
+        return _current_shard.get()
+
+    @staticmethod
+    def activate(shard):
+        """Route sharded tables to `shard` for the rest of this request"""
+        _current_shard.set(shard)
+
+    @contextmanager
+    def use(self, shard):
+        token = _current_shard.set(shard)
+        try:
+            yield shard
+        finally:
+            _current_shard.reset(token)
+
+    def each(self):
+        """Run the loop body once per shard, with that shard active"""
+        for shard in self.ids:
+            with self.use(shard):
+                yield shard
+
+    def gather(self, query):
+        """All rows of a query from every shard, shard by shard"""
+        rows = []
+        for _ in self.each():
+            rows.extend(query.all())
+        return rows
+
+    def count(self, query):
+        return sum(query.count() for _ in self.each())
+
+    def gather_page(self, query, order, per_page, after=None):
+        """Newest-first page of a query across every shard, continued by a keyset cursor
+
+        order are the columns to sort on, descending, ending in a unique one,
+        e.g. (parking_timestamp, id); `after` holds their values on the
+        previous page's last row. Each shard reads at most per_page + 1 rows
+        however far back the page is. Returns (rows, next cursor or None).
+        """
+        if after is not None:
+            query = query.filter(sa.tuple_(*order) < tuple(after))
+        rows = self.gather(query.order_by(*(column.desc() for column in order)).limit(per_page + 1))
+
+        def values(row):
+            return tuple(getattr(row, column.key) for column in order)
+        rows.sort(key=values, reverse=True)
+        next_cursor = values(rows[per_page - 1]) if len(rows) > per_page else None
+        return rows[:per_page], next_cursor
+
+
+shards = ShardRouter()
+
+
+def _table_name(mapper, clause):
+    if mapper is not None:
+        return sa.inspect(mapper).local_table.name
+    table = getattr(clause, 'table', clause)  # INSERT/UPDATE/DELETE statements carry their table
+    return getattr(table, 'name', None)
+
+
+class ShardRoutingSession(Session):
+    """Session that sends sharded tables to the active shard's engine"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None:
+            shard = _current_shard.get()
+            if shard != PRIMARY_SHARD and _table_name(mapper, clause) in SHARDED_TABLES:
+                return self._db.engines[shards.bind_key(shard)]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
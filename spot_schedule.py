@@ -0,0 +1,98 @@
+from bisect import bisect_left, insort
+from threading import Lock
+
+
+class SpotSchedule:
+    """Per-spot interval index of advance bookings.
+
+    Every spot keeps its booked windows as a sorted list of non-overlapping
+    (start, end, booking_id) segments. Because the segments never overlap,
+    both starts and ends are sorted, so a conflict check only has to look at
+    the one segment that starts just before the requested window ends.
+
+    Each spot also remembers the booking version it was loaded at. Other
+    workers change bookings behind this index's back, so callers compare
+    versions with the database and reload the spots that moved on.
+    """
+
+    def __init__(self):
+        self._segments = {}
+        self._versions = {}
+        self._lock = Lock()
+        self.loaded = False
+
+    def load(self, bookings, versions):
+        """Replace the whole index from (spot_id, start, end, booking_id) rows
+
+        versions are (spot_id, booking_version) rows read before the bookings.
+        """
+        segments = {}
+        for spot_id, start, end, booking_id in bookings:
+            segments.setdefault(spot_id, []).append((start, end, booking_id))
+        for spot_segments in segments.values():
+            spot_segments.sort()
+        with self._lock:
+            self._segments = segments
+            self._versions = dict(versions)
+            self.loaded = True
+
+    def replace_spot(self, spot_id, bookings, version):
+        """Replace one spot's segments from (start, end, booking_id) rows"""
+        spot_segments = sorted(bookings)
+        with self._lock:
+            if spot_segments:
+                self._segments[spot_id] = spot_segments
+            else:
+                self._segments.pop(spot_id, None)
+            self._versions[spot_id] = version
+
+    def stale(self, versions):
+        """Spot ids among (spot_id, booking_version) rows whose segments are out of date"""
+        return [spot_id for spot_id, version in versions if self._versions.get(spot_id) != version]
+
+    def add(self, spot_id, start, end, booking_id):
+        """Record a booked window on a spot"""
+        with self._lock:
+            insort(self._segments.setdefault(spot_id, []), (start, end, booking_id))
+
+    def remove(self, spot_id, booking_id):
+        """Forget a booking, e.g. after it is cancelled"""
+        with self._lock:
+            spot_segments = self._segments.get(spot_id, [])
+            spot_segments[:] = [s for s in spot_segments if s[2] != booking_id]
+            if not spot_segments:
+                self._segments.pop(spot_id, None)
+
+    def prune(self, before):
+        """Drop segments that ended at or before the given time"""
+        with self._lock:
+            for spot_id in list(self._segments):
+                spot_segments = self._segments[spot_id]
+                # Ends are sorted too, so expired segments form a prefix
+                keep = 0
+                while keep < len(spot_segments) and spot_segments[keep][1] <= before:
+                    keep += 1
+                if keep == len(spot_segments):
+                    del self._segments[spot_id]
+                elif keep:
+                    del spot_segments[:keep]
+
+    def is_free(self, spot_id, start, end):
+        """True if no booked window on the spot overlaps [start, end)"""
+        spot_segments = self._segments.get(spot_id)
+        if not spot_segments:
+            return True
+        # First segment starting at or after `end`; only its predecessor can overlap
+        i = bisect_left(spot_segments, (end,))
+        return i == 0 or spot_segments[i - 1][1] <= start
+
+    def find_free_spot(self, spot_ids, start, end):
+        """First spot id (in the given order) that is free for [start, end)"""
+        for spot_id in spot_ids:
+            if self.is_free(spot_id, start, end):
+                return spot_id
+        return None
+
+    def windows(self, spot_id):
+        """Booked (start, end, booking_id) segments of a spot, in order"""
+        return list(self._segments.get(spot_id, []))